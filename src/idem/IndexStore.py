@@ -4,26 +4,19 @@ from collections.abc import Sequence
 from pathlib import Path
 from typing import cast
 
+from .config import ConfigError
 from .index_db import IndexDB
 from .models import ContentStats, DirStats, FileMetadata, FileStats, IntegrityStats, StatusSnapshot
-from .sql import dirs, files, hashes
+from .sql import dirs, files, hashes, settings
+
+# Stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds (999).
+MAX_SQL_VARIABLES: int = 500
 
 
 class IndexStore:
     def __init__(self, index_db: IndexDB) -> None:
         self.db: IndexDB = index_db
 
-    def fetchone(self, sql: str, params: Sequence[object]) -> sqlite3.Row:
-        cursor: sqlite3.Cursor = self.db.connection.cursor()
-
-        _ = cursor.execute(sql, params)
-        row: sqlite3.Row | None = self.db.query_one(sql, params)
-        assert row is not None
-
-        cursor.close()
-
-        return row
-
     def insert_root_dirs(self, root_dirs: list[str]) -> None:
         for root_path in root_dirs:
             scan_started_at: int = time.time_ns()
@@ -45,45 +38,87 @@ class IndexStore:
             ),
         )
 
-    def upset_file_metadata(
-        self,
-        *,
-        path: Path,
-        dir_id: int,
-        size: int,
-        mtime_ns: int,
-        inode: int,
-        device: int,
-        hash_id: int,
-    ) -> None:
-        self.db.execute(
-            sql=files.UPSERT_FILE_METEDATA, params=(path, dir_id, size, mtime_ns, inode, device, hash_id)
-        )
-
-    def get_or_create_hash(self, hash_hex: str, file_size: int) -> int:
-        self.db.execute(sql=hashes.STORE_HASH, params=(hash_hex, file_size))
-        row: sqlite3.Row | None = self.db.query_one(sql=hashes.GET_HASH_ID, params=(hash_hex,))
+    def check_hash_algo(self, hash_algo: str) -> None:
+        """
+        Record `hash_algo` for a new index, or raise ConfigError if the index was
+        built with a different content fingerprint.
+        """
+        self.db.execute(sql=settings.INSERT_SETTING, params=("hash_algo", hash_algo))
+        row: sqlite3.Row | None = self.db.query_one(sql=settings.SELECT_SETTING, params=("hash_algo",))
 
         assert row is not None
 
-        return cast(int, row["id"])
+        stored: str = cast(str, row["value"])
+        if stored != hash_algo:
+            raise ConfigError(
+                f"Index was built with hash_algo {stored!r}, but the config asks for {hash_algo!r}."
+            )
 
-    def upsert_file_metadata(self, meta: FileMetadata) -> None:
-        self.db.execute(
+    def get_or_create_hashes(self, entries: Sequence[tuple[str, int]]) -> dict[str, int]:
+        """
+        Store `(hash_hex, file_size)` pairs that are not known yet and return the
+        id of every given hash.
+        """
+        self.db.executemany(sql=hashes.STORE_HASH, params=entries)
+
+        hash_ids: dict[str, int] = {}
+        unique_hashes: list[str] = list({hash_hex for hash_hex, _ in entries})
+
+        for start in range(0, len(unique_hashes), MAX_SQL_VARIABLES):
+            chunk: list[str] = unique_hashes[start : start + MAX_SQL_VARIABLES]
+            sql: str = hashes.SELECT_IDS_BY_HASH.format(placeholders=", ".join("?" * len(chunk)))
+
+            for row in self.db.query_all(sql=sql, params=chunk):
+                hash_ids[cast(str, row["hash"])] = cast(int, row["id"])
+
+        return hash_ids
+
+    def upsert_file_metadata_many(self, metas: Sequence[FileMetadata]) -> None:
+        self.db.executemany(
             sql=files.UPSERT_FILE_METEDATA,
             params=(
-                meta.path,
-                meta.dir_id,
-                meta.size,
-                meta.mtime_ns,
-                meta.inode,
-                meta.device,
-                meta.hash_id,
+                (
+                    meta.path,
+                    meta.dir_id,
+                    meta.size,
+                    meta.mtime_ns,
+                    meta.inode,
+                    meta.device,
+                    meta.hash_id,
+                    meta.last_seen,
+                )
+                for meta in metas
             ),
         )
 
-    def mark_files_seen_in_dir(self, dir_id: int, seen_at: int) -> None:
-        self.db.execute(sql=files.UPDATE_LAST_SEEN, params=(dir_id, seen_at))
+    def get_dir_file_metadata(self, dir_id: int) -> dict[str, sqlite3.Row]:
+        """
+        Return the stored stat signature and hash id of every indexed file in a
+        directory, keyed by path.
+        """
+        rows: list[sqlite3.Row] = self.db.query_all(sql=files.SELECT_METADATA_BY_DIR, params=(dir_id,))
+
+        return {cast(str, row["path"]): row for row in rows}
+
+    def mark_files_stale(self, paths: Sequence[str]) -> None:
+        """
+        Mark files that are no longer on disk as stale.
+        """
+        self.db.executemany(sql=files.MARK_STALE, params=((path,) for path in paths))
+
+    def get_unhashed_size_collisions(self, *, after: tuple[int, int], limit: int) -> list[sqlite3.Row]:
+        """
+        Return up to `limit` current files that have no hash yet and share their
+        size with another current file, ordered by `(size, id)` and starting
+        after `after`.
+        """
+        return self.db.query_all(sql=files.SELECT_UNHASHED_SIZE_COLLISIONS, params=(*after, limit))
+
+    def set_file_hash_ids_many(self, entries: Sequence[tuple[int, int]]) -> None:
+        """
+        Store `(hash_id, file_id)` pairs.
+        """
+        self.db.executemany(sql=files.UPDATE_HASH_ID, params=entries)
 
     def begin(self) -> None:
         self.db.begin()
@@ -94,6 +129,12 @@ class IndexStore:
     def rollback(self) -> None:
         self.db.rollback()
 
+    def begin_bulk_scan(self) -> None:
+        self.db.begin_bulk_scan()
+
+    def end_bulk_scan(self) -> None:
+        self.db.end_bulk_scan()
+
     def reset_inflight_dirs(self) -> None:
         """
         Reset directories that were left in 'indexing' state due to
@@ -101,20 +142,14 @@ class IndexStore:
         """
         self.db.execute(sql=dirs.RESET_INFLIGHT_DIR)
 
-    def get_next_pending_dir(self) -> sqlite3.Row | None:
+    def claim_pending_dirs(self, limit: int) -> list[sqlite3.Row]:
         """
-        Return one directory with status='pending', or None if none remain.
+        Atomically mark up to `limit` pending directories as 'indexing' and
+        return their ids and paths in id order. An empty list means none remain.
         """
+        rows: list[sqlite3.Row] = self.db.query_all(sql=dirs.CLAIM_PENDING_DIRS, params=(limit,))
 
-        row: sqlite3.Row | None = self.db.query_one(sql=dirs.GET_NEXT_PENDING_DIR)
-
-        return row
-
-    def mark_dir_indexing(self, dir_id: int) -> None:
-        """
-        Mark a directory as currently being indexed.
-        """
-        self.db.execute(sql=dirs.MARK_AS_INDEXING, params=(dir_id,))
+        return sorted(rows, key=lambda row: cast(int, row["id"]))
 
     def mark_dir_done(self, dir_id: int, *, seen_at: int) -> None:
         """
@@ -122,11 +157,11 @@ class IndexStore:
         """
         self.db.execute(sql=dirs.MARK_AS_DONE, params=(seen_at, dir_id))
 
-    def insert_dir(self, *, path: str) -> None:
+    def insert_dirs_many(self, paths: Sequence[str]) -> None:
         """
-        Insert a directory into the dirs table if it does not already exist.
+        Insert several directories into the dirs table, skipping existing ones.
         """
-        self.db.execute(sql=dirs.INSERT_DIR, params=(path,))
+        self.db.executemany(sql=dirs.INSERT_DIR, params=((path,) for path in paths))
 
     def _get_dir_stats(self) -> DirStats:
         row: sqlite3.Row | None = self.db.query_one(
@@ -152,48 +187,56 @@ class IndexStore:
         )
 
     def _get_file_stats(self, last_scan: int | None) -> FileStats:
-        row = self.db.query_one(
-            """
-            SELECT
-            COUNT(*) AS total_files,
-            SUM(last_seen = ?) AS files_seen_last_scan,
-            SUM(last_seen < ? OR last_seen IS NULL) AS stale_files,
-            COALESCE(SUM(size), 0) AS total_bytes
-            FROM files;
-            """,
-            params=(last_scan, last_scan),
-        )
+        row = self.db.query_one(sql=files.SELECT_FILE_STATS, params=(last_scan, last_scan))
 
         assert row is not None
 
+        total_files: int = cast(int, row["total_files"])
+        stale_files: int = cast(int, row["stale_files"])
+
+        # Files that are not stale and were not seen before or after the last scan
+        # were seen by it. Counting the small ranges keeps this off the full files table.
+        files_seen_last_scan: int = 0
+        if last_scan is not None:
+            files_seen_last_scan = (
+                total_files - stale_files - cast(int, row["older_files"]) - cast(int, row["newer_files"])
+            )
+
         return FileStats(
-            total_files=cast(int, row["total_files"]),
-            files_seen_last_scan=cast(int, row["files_seen_last_scan"] or 0),
-            stale_files=cast(int, row["stale_files"] or 0),
+            total_files=total_files,
+            files_seen_last_scan=files_seen_last_scan,
+            stale_files=stale_files,
             total_bytes=cast(int, row["total_bytes"]),
         )
 
     def _get_content_stats(self) -> ContentStats:
+        # Stale files are no longer on disk and are left out. Both parts read only
+        # idx_files_hash_id_size_last_seen and idx_files_size_last_seen.
         row = self.db.query_one(
             """
             WITH per_hash AS (
-            SELECT hash_id, COUNT(*) AS n
-            FROM files
-            GROUP BY hash_id
-            ),
-            ambiguous AS (
-            SELECT hash_id
+            SELECT COUNT(*) AS n, MIN(size) != MAX(size) AS mixed_sizes
             FROM files
+            WHERE hash_id IS NOT NULL AND last_seen IS NOT NULL
             GROUP BY hash_id
-            HAVING COUNT(DISTINCT size) > 1
             )
             SELECT
-            SUM(n = 1) AS unique_hashes,
+            -- A file left unhashed is only known to be unique when no other file has its size.
+            COALESCE(SUM(n = 1), 0) + (
+                SELECT COUNT(*)
+                FROM files AS f
+                WHERE f.hash_id IS NULL
+                    AND f.last_seen IS NOT NULL
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM files AS other
+                        WHERE other.size = f.size AND other.last_seen IS NOT NULL AND other.id != f.id
+                    )
+            ) AS unique_hashes,
             SUM(n > 1) AS duplicate_groups,
             COALESCE(SUM(CASE WHEN n > 1 THEN n ELSE 0 END), 0) AS duplicate_files,
-            (SELECT COUNT(*) FROM ambiguous) AS unresolved_groups,
-            (SELECT COUNT(*) FROM files WHERE hash_id IN (SELECT hash_id FROM ambiguous))
-                AS unresolved_files
+            COALESCE(SUM(mixed_sizes), 0) AS unresolved_groups,
+            COALESCE(SUM(CASE WHEN mixed_sizes THEN n ELSE 0 END), 0) AS unresolved_files
             FROM per_hash;
             """
         )
@@ -215,7 +258,7 @@ class IndexStore:
             (SELECT COUNT(*) FROM files WHERE dir_id NOT IN (SELECT id FROM dirs))
                 AS orphaned_files,
             (SELECT COUNT(*) FROM hashes
-                WHERE id NOT IN (SELECT DISTINCT hash_id FROM files))
+                WHERE id NOT IN (SELECT DISTINCT hash_id FROM files WHERE hash_id IS NOT NULL))
                 AS orphaned_hashes;
             """
         )
@@ -1,9 +1,29 @@
+import functools
 from dataclasses import dataclass
+from enum import StrEnum
 from pathlib import Path
-from typing import NoReturn, TypedDict, cast
+from typing import NoReturn, NotRequired, TypedDict, cast
 
 import yaml
 
+from .index_db import SYNCHRONOUS_MODES
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
+
+class HashAlgo(StrEnum):
+    """
+    Content fingerprints an index can be built with. BLAKE3 and XXH3-128 need
+    the optional fast-hash extra.
+    """
+
+    SHA256 = "sha256"
+    BLAKE3 = "blake3"
+    XXH128 = "xxh128"
+
 
 class RawAppConfig(TypedDict):
     root_paths: list[str]
@@ -12,6 +32,9 @@ class RawAppConfig(TypedDict):
     max_inflight: int
     chunk_size: int
     batch_size: int
+    synchronous: NotRequired[str]
+    io_bandwidth_mb_s: NotRequired[int]
+    hash_algo: NotRequired[str]
 
 
 class RawConfigFile(TypedDict):
@@ -20,11 +43,46 @@ class RawConfigFile(TypedDict):
 
 CONFIG_FILENAME: Path = Path("config.yaml")
 
+# Multipliers for the size suffixes accepted by parse_chunk_size.
+SIZE_SUFFIXES: dict[str, int] = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+class ConfigError(ValueError):
+    """
+    The configuration is invalid or does not match the index it points at.
+    """
+
 
 def type_error(value: object) -> NoReturn:
     raise TypeError(f"Unexpected value of wrong type: {value!r}")
 
 
+def parse_chunk_size(value: str) -> int:
+    """
+    Parse a size in bytes, optionally followed by a K, M or G suffix.
+    """
+    text: str = value.strip().upper()
+    multiplier: int = SIZE_SUFFIXES.get(text[-1:], 1)
+    number: str = text[:-1] if multiplier != 1 else text
+
+    try:
+        return int(number) * multiplier
+    except ValueError:
+        raise ValueError(
+            "Specified chunk size is not a number. Only K, M and G are allowed suffixes."
+        ) from None
+
+
+@functools.lru_cache(maxsize=4)
+def _load_yaml(path: str, _mtime_ns: int) -> object | None:
+    """
+    Parse a YAML file. `_mtime_ns` is only part of the cache key, so an edited
+    file is parsed again.
+    """
+    with open(path, "r", encoding="UTF-8") as f:
+        return cast(object, yaml.load(f, Loader=SafeLoader))
+
+
 @dataclass(slots=True)
 class AppConfig:
     root_paths: list[Path]
@@ -33,17 +91,19 @@ class AppConfig:
     max_inflight: int
     chunk_size: int
     batch_size: int
+    synchronous: str = "NORMAL"
+    io_bandwidth_mb_s: int = 500
+    hash_algo: HashAlgo = HashAlgo.SHA256
 
     @staticmethod
     def load(path: Path = CONFIG_FILENAME) -> "AppConfig":
         if not path.exists():
             raise FileNotFoundError("Missing config file. Run idem init first.")
 
-        with path.open("r", encoding="UTF-8") as f:
-            raw_loaded_obj: object | None = cast(object, yaml.safe_load(f))
+        raw_loaded_obj: object | None = _load_yaml(str(path), path.stat().st_mtime_ns)
 
         if not raw_loaded_obj:
-            raise ValueError("Config file is empty or invalid YAML.")
+            raise ConfigError("Config file is empty or invalid YAML.")
 
         if not isinstance(raw_loaded_obj, dict):
             type_error(raw_loaded_obj)
@@ -56,6 +116,25 @@ class AppConfig:
 
         cfg: RawAppConfig = cast(RawAppConfig, cast(object, cfg_raw))
 
+        try:
+            hash_algo: HashAlgo = HashAlgo(cfg.get("hash_algo", HashAlgo.SHA256))
+        except ValueError:
+            choices: str = ", ".join(algo.value for algo in HashAlgo)
+            raise ConfigError(f"hash_algo must be one of {choices}, got {cfg.get('hash_algo')!r}.") from None
+
+        # YAML 1.1 reads an unquoted OFF as false.
+        raw_synchronous: object = cfg.get("synchronous", "NORMAL")
+        synchronous: str = "OFF" if raw_synchronous is False else str(raw_synchronous).upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            modes: str = ", ".join(SYNCHRONOUS_MODES)
+            raise ConfigError(f"synchronous must be one of {modes}, got {cfg.get('synchronous')!r}.")
+
+        io_bandwidth_mb_s: object = cfg.get("io_bandwidth_mb_s", 500)
+        if type(io_bandwidth_mb_s) is not int or io_bandwidth_mb_s <= 0:
+            raise ConfigError(
+                f"io_bandwidth_mb_s must be a whole number of MB/s above 0, got {io_bandwidth_mb_s!r}."
+            )
+
         appConfig: AppConfig = AppConfig(
             root_paths=[Path(path) for path in cfg["root_paths"]],
             db_path=Path(cfg["db_path"]),
@@ -63,6 +142,9 @@ class AppConfig:
             max_inflight=cfg["max_inflight"],
             chunk_size=cfg["chunk_size"],
             batch_size=cfg["batch_size"],
+            synchronous=synchronous,
+            io_bandwidth_mb_s=io_bandwidth_mb_s,
+            hash_algo=hash_algo,
         )
 
         return appConfig
@@ -80,4 +162,7 @@ class AppConfig:
             "max_inflight": self.max_inflight,
             "chunk_size": self.chunk_size,
             "batch_size": self.batch_size,
+            "synchronous": self.synchronous,
+            "io_bandwidth_mb_s": self.io_bandwidth_mb_s,
+            "hash_algo": self.hash_algo.value,
         }
@@ -1,142 +1,245 @@
 import fcntl
+import functools
 import hashlib
 import os
 import sqlite3
+import threading
 import time
-from collections.abc import Generator, Iterable, Iterator
-from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from collections.abc import Callable, Generator, Iterable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ThreadPoolExecutor, as_completed, wait
 from contextlib import contextmanager
 from pathlib import Path
-from typing import cast
+from typing import TYPE_CHECKING, Protocol, cast
 
 import typer
 
-from .config import AppConfig
+from .config import AppConfig, ConfigError, HashAlgo
 from .index_db import IndexDB
 from .IndexStore import IndexStore
 from .models import FileMetadata
 
+if TYPE_CHECKING:
+    from collections.abc import Buffer
 
-@contextmanager
-def dir_lock(path: Path) -> Generator[None, None, None]:
-    lock_file: Path = path / ".lock-duplicate"
-    lock_file.touch()
+# Files up to this size are read ahead in full with POSIX_FADV_WILLNEED.
+PREFETCH_LIMIT: int = 1024 * 1024
+
+# Files smaller than this are hashed in groups of up to FILES_PER_TASK per worker task.
+SMALL_FILE_SIZE: int = 64 * 1024
+FILES_PER_TASK: int = 16
+
+# Number of pending directories claimed from the database at a time.
+CLAIM_BATCH_SIZE: int = 256
+
+# Queue at most this many seconds of reads, at the configured I/O bandwidth, so a
+# slow disk is not flooded with concurrent reads that only make it seek.
+TARGET_IO_BACKLOG_S: float = 1.0
+# io_bandwidth_mb_s is in decimal megabytes, the unit disk throughput is quoted in.
+BYTES_PER_MB: int = 1000 * 1000
+
+# posix_fadvise is not available on every platform (e.g. macOS).
+HAS_FADVISE: bool = hasattr(os, "posix_fadvise")
+
+
+class Hasher(Protocol):
+    def update(self, data: "Buffer", /) -> object: ...
+
+    def hexdigest(self) -> str: ...
+
+
+def resolve_hasher(algo: HashAlgo, *, max_workers: int) -> Callable[[], Hasher]:
+    """
+    Return the constructor for the content fingerprint named by `algo`.
+
+    BLAKE3 and XXH3-128 are much faster than SHA-256 but need the optional
+    `blake3` and `xxhash` packages.
+    """
+    if algo is HashAlgo.SHA256:
+        return hashlib.sha256
 
     try:
-        with open(file=lock_file, mode="w") as f:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            yield
-    finally:
-        lock_file.unlink(missing_ok=True)
+        if algo is HashAlgo.BLAKE3:
+            import blake3
+
+            if max_workers > 1:
+                return blake3.blake3
 
+            # With a single hashing worker, let BLAKE3 spread each buffer over the cores
+            # itself; with more, every worker would start its own threads on top.
+            return functools.partial(blake3.blake3, max_threads=blake3.blake3.AUTO)
 
-def find_all_files(path: Path) -> Iterator[str]:
+        import xxhash
+
+        return xxhash.xxh3_128
+    except ImportError as e:
+        raise ConfigError(f"hash_algo {algo.value!r} requires the idem-prune[fast-hash] extra") from e
+
+
+# Per-thread read buffer for calculate_digest, so each hashing worker allocates it once.
+_read_buffers: threading.local = threading.local()
+
+
+def _read_buffer(size: int) -> memoryview:
     """
-    Recursively yield all file paths under the given directory.
-
-    Resolves the provided path, validates that it exists and is a
-    directory, and then yields file paths relative to the root
-    directory.
-
-    Parameters
-    ----------
-    path : Path
-        The directory to search in.
-
-    Yields
-    ------
-    str
-        Relative file paths.
-
-    Raises
-    ------
-    ValueError
-        If the path does not exist or is not a directory.
+    Return the calling thread's read buffer of `size` bytes.
     """
-    top_path: Path = path.resolve()
+    view: memoryview | None = cast(memoryview | None, getattr(_read_buffers, "view", None))
 
-    if not top_path.exists():
-        raise ValueError(f"{top_path} does not exists.")
-    if not top_path.is_dir():
-        raise ValueError(f"{top_path} is not a directorie.")
+    if view is None or len(view) != size:
+        view = memoryview(bytearray(size))
+        _read_buffers.view = view
 
-    for root, _, files in os.walk(top_path):
-        for filename in files:
-            full_path: Path = Path(root) / filename
-            yield str(full_path)
+    return view
 
 
-def calculate_sha256(path: Path, chunk_size: int) -> str:
-    hash = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            hash.update(chunk)
-    return hash.hexdigest()
+class IndexLockedError(RuntimeError):
+    """
+    Another idem process is already indexing into the same database.
+    """
 
 
-def hash_files_parallel_bounded(
-    paths: Iterable[Path], max_workers: int, max_in_flight: int, chunk_size: int
-) -> Iterator[tuple[Path, str]]:
-    if max_in_flight <= 0:
-        raise ValueError("max_in_flight must be > 0")
-    if max_workers <= 0:
-        raise ValueError("max_workers must be > 0")
+@contextmanager
+def index_lock(db_path: Path) -> Generator[None, None, None]:
+    """
+    Hold an exclusive lock on `<db_path>.lock` while indexing, so two idem
+    processes never scan into the same index at once.
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        in_flight: dict[Future[str], Path] = {}
+    The lock file is left in place; removing it while locked would let a
+    second process lock a fresh file of the same name.
+    """
+    lock_path: Path = db_path.with_name(f"{db_path.name}.lock")
 
-        def submit(path: Path) -> None:
-            future: Future[str] = executor.submit(calculate_sha256, path, chunk_size)
-            in_flight[future] = path
+    with open(lock_path, "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise IndexLockedError(f"Another idem index is already running on {db_path}.") from None
 
-        for path in paths:
-            # Apply backpressure
-            while len(in_flight) >= max_in_flight:
-                done: Future[str] = next(as_completed(in_flight))
-                yield in_flight.pop(done), done.result()
+        yield
 
-            submit(path)
 
-        # Drain remaining futures
-        for future in as_completed(in_flight):
-            yield in_flight[future], future.result()
+def calculate_digest(path: str, chunk_size: int, new_hash: Callable[[], Hasher] = hashlib.sha256) -> str:
+    hash = new_hash()
 
+    with open(path, "rb", buffering=0) as f:
+        fd: int = f.fileno()
+        size: int = os.fstat(fd).st_size
 
-def walk_files(root: Path) -> Iterator[Path]:
-    resolved_root: Path = root.resolve()
+        # No mmap: a file truncated while it is mapped raises SIGBUS and would take
+        # down every hashing thread, and live trees change under a scan.
+        try:
+            if HAS_FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                if size <= PREFETCH_LIMIT:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
+            view: memoryview = _read_buffer(chunk_size)
+
+            # Unbuffered reads straight into the thread's buffer, the same loop
+            # hashlib.file_digest uses, but with the configured chunk size.
+            while n := f.readinto(view):
+                _ = hash.update(view[:n])
+        finally:
+            # Each file is read once; do not let a large scan evict the rest of the page cache.
+            if HAS_FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
 
-    if not resolved_root.exists():
-        raise ValueError(f"{resolved_root} does not exist")
-    if not resolved_root.is_dir():
-        raise ValueError(f"{resolved_root} is not a directory")
+    return hash.hexdigest()
 
-    for dirpath, _, filenames in os.walk(resolved_root):
-        base: Path = Path(dirpath)
-        for name in filenames:
-            path: Path = base / name
-            if path.is_symlink():
-                print(f"Symlink: {path}")
-                continue
 
-            if path.stat().st_size == 0:
-                continue
+def calculate_digest_batch(
+    paths: Sequence[str], chunk_size: int, new_hash: Callable[[], Hasher]
+) -> list[tuple[str, str]]:
+    """
+    Hash several files in one worker task.
+
+    Small files are grouped so the per-task dispatch cost is paid once per
+    group instead of once per file. Files that can no longer be read are
+    left out of the result.
+    """
+    digests: list[tuple[str, str]] = []
 
-            try:
-                _ = path.stat()
-            except FileNotFoundError:
-                continue
+    for path in paths:
+        try:
+            digests.append((path, calculate_digest(path, chunk_size, new_hash)))
+        except (FileNotFoundError, PermissionError):
+            # Gone or unreadable since it was listed; leave it unhashed.
+            continue
 
-            yield base / name
+    return digests
 
 
-def discover_dir_entries(path: Path) -> tuple[list[Path], list[Path]]:
+def hash_files_parallel_bounded(
+    files: Iterable[tuple[str, int]],
+    executor: Executor,
+    max_in_flight: int,
+    chunk_size: int,
+    max_in_flight_bytes: int,
+    new_hash: Callable[[], Hasher] = hashlib.sha256,
+) -> Iterator[tuple[str, str]]:
     """
-    Return immediate subdirectories and files of `path`.
+    Hash `(path, size)` pairs on `executor` and yield `(path, hex digest)` pairs.
 
-    Symlinks and zero-length files are ignored.
+    Files smaller than SMALL_FILE_SIZE are grouped up to FILES_PER_TASK per
+    task; larger files get a task of their own. At most `max_in_flight` tasks
+    and, unless a single task is larger, `max_in_flight_bytes` bytes are queued
+    at any time.
     """
-    subdirs: list[Path] = []
-    files: list[Path] = []
+    if max_in_flight <= 0:
+        raise ValueError("max_in_flight must be > 0")
+    if max_in_flight_bytes <= 0:
+        raise ValueError("max_in_flight_bytes must be > 0")
+
+    in_flight: dict[Future[list[tuple[str, str]]], int] = {}
+    in_flight_bytes: int = 0
+    small_files: list[str] = []
+    small_files_bytes: int = 0
+
+    def submit(batch: list[str], batch_bytes: int) -> Iterator[tuple[str, str]]:
+        nonlocal in_flight_bytes
+
+        # Apply backpressure: wait once, then hand back every future that has finished
+        while in_flight and (
+            len(in_flight) >= max_in_flight or in_flight_bytes + batch_bytes > max_in_flight_bytes
+        ):
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight_bytes -= in_flight.pop(future)
+                yield from future.result()
+
+        in_flight[executor.submit(calculate_digest_batch, batch, chunk_size, new_hash)] = batch_bytes
+        in_flight_bytes += batch_bytes
+
+    for path, size in files:
+        if size >= SMALL_FILE_SIZE:
+            yield from submit([path], size)
+            continue
+
+        small_files.append(path)
+        small_files_bytes += size
+        if len(small_files) >= FILES_PER_TASK:
+            yield from submit(small_files, small_files_bytes)
+            small_files = []
+            small_files_bytes = 0
+
+    if small_files:
+        yield from submit(small_files, small_files_bytes)
+
+    # Drain remaining futures
+    for future in as_completed(in_flight):
+        yield from future.result()
+
+
+def discover_dir_entries(path: str) -> tuple[list[str], list[tuple[str, os.stat_result]]]:
+    """
+    Return immediate subdirectories of `path`, and its files together with
+    their stat results.
+
+    Symlinks and zero-length files are ignored. A directory that cannot be
+    listed has no entries.
+    """
+    subdirs: list[str] = []
+    files: list[tuple[str, os.stat_result]] = []
 
     try:
         with os.scandir(path) as it:
@@ -145,159 +248,247 @@ def discover_dir_entries(path: Path) -> tuple[list[Path], list[Path]]:
                     continue
 
                 if entry.is_dir(follow_symlinks=False):
-                    subdirs.append(Path(entry.path))
+                    subdirs.append(entry.path)
                 elif entry.is_file(follow_symlinks=False):
                     try:
-                        st = entry.stat()
-                    except FileNotFoundError:
+                        st = entry.stat(follow_symlinks=False)
+                    except (FileNotFoundError, PermissionError):
                         continue
 
                     if st.st_size == 0:
                         continue
 
-                    files.append(Path(entry.path))
-    except FileNotFoundError:
-        # Directory disappeared between discovery and processing
+                    files.append((entry.path, st))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        # Directory disappeared, was replaced by a file or cannot be read; it is
+        # recorded as empty instead of aborting the run.
         pass
 
     return subdirs, files
 
 
+def is_unchanged(row: sqlite3.Row | None, st: os.stat_result) -> bool:
+    """
+    Return True when the stored stat signature matches the file on disk.
+    """
+    if row is None:
+        return False
+
+    return (
+        cast(int, row["size"]) == st.st_size
+        and cast(int, row["mtime_ns"]) == st.st_mtime_ns
+        and cast(int, row["inode"]) == st.st_ino
+        and cast(int, row["device"]) == st.st_dev
+    )
+
+
 def index_files_in_dir(
     *,
     store: IndexStore,
     dir_id: int,
-    files: list[Path],
-    max_workers: int,
-    max_in_flight: int,
-    chunk_size: int,
-    batch_size: int,
+    files: list[tuple[str, os.stat_result]],
+    seen_at: int,
 ) -> None:
-    processed: int = 0
-
-    for file_path, hash_hex in hash_files_parallel_bounded(
-        paths=files,
-        max_workers=max_workers,
-        max_in_flight=max_in_flight,
-        chunk_size=chunk_size,
-    ):
-        try:
-            st = file_path.stat()
-        except (FileNotFoundError, PermissionError):
-            continue
-
-        hash_id = store.get_or_create_hash(
-            hash_hex=hash_hex,
-            file_size=st.st_size,
-        )
+    """
+    Record the stat signature of every file in a directory as seen at `seen_at`,
+    without hashing anything. Runs inside the caller's per-directory transaction.
 
-        meta = FileMetadata(
-            path=str(file_path),
-            dir_id=dir_id,
-            size=st.st_size,
-            mtime_ns=st.st_mtime_ns,
-            inode=st.st_ino,
-            device=st.st_dev,
-            hash_id=hash_id,
+    Unchanged files keep their stored hash_id. New and changed files get an
+    empty one; hash_size_collisions fills it in afterwards for the files that
+    can have a duplicate. Stored files that are gone from the directory are
+    marked stale.
+    """
+    stored: dict[str, sqlite3.Row] = store.get_dir_file_metadata(dir_id)
+    metas: list[FileMetadata] = []
+
+    for file_path, st in files:
+        row: sqlite3.Row | None = stored.get(file_path)
+        hash_id: int | None = None
+        if row is not None and is_unchanged(row, st):
+            hash_id = cast(int | None, row["hash_id"])
+
+        metas.append(
+            FileMetadata(
+                path=file_path,
+                dir_id=dir_id,
+                size=st.st_size,
+                mtime_ns=st.st_mtime_ns,
+                inode=st.st_ino,
+                device=st.st_dev,
+                hash_id=hash_id,
+                last_seen=seen_at,
+            )
         )
 
-        store.upsert_file_metadata(meta)
+    store.upsert_file_metadata_many(metas)
 
-        processed += 1
-        if processed >= batch_size:
-            store.commit()
-            store.begin()
-            processed = 0
-
-    if processed > 0:
-        store.commit()
-        store.begin()
+    seen_paths: set[str] = {file_path for file_path, _ in files}
+    gone_paths: list[str] = [path for path in stored if path not in seen_paths]
+    if gone_paths:
+        store.mark_files_stale(gone_paths)
 
 
 def index_single_dir(
     *,
     store: IndexStore,
     dir_id: int,
-    dir_path: Path,
+    subdirs: list[str],
+    files: list[tuple[str, os.stat_result]],
     seen_at: int,
-    max_workers: int,
-    max_in_flight: int,
-    chunk_size: int,
-    batch_size: int,
 ) -> None:
     """
-    Index exactly one directory.
+    Index exactly one directory from its discovered entries.
 
-    - Discover immediate subdirectories and enqueue them
-    - Hash files in this directory only
-    - Upsert file metadata
-    - Mark files as seen for this scan
+    - Enqueue its immediate subdirectories
+    - Upsert file metadata of files in this directory only, marking them as
+      seen for this scan
     """
 
-    subdirs: list[Path] = []
-    files: list[Path] = []
-
-    subdirs, files = discover_dir_entries(path=dir_path)
-
-    for subdir in subdirs:
-        store.insert_dir(path=str(subdir))
+    if subdirs:
+        store.insert_dirs_many(subdirs)
 
     index_files_in_dir(
         store=store,
         dir_id=dir_id,
         files=files,
-        max_workers=max_workers,
-        max_in_flight=max_in_flight,
-        chunk_size=chunk_size,
-        batch_size=batch_size,
-    )
-
-    # --- finalize directory ---
-    store.mark_files_seen_in_dir(
-        dir_id=dir_id,
         seen_at=seen_at,
     )
 
 
+def hash_size_collisions(
+    *,
+    store: IndexStore,
+    executor: Executor,
+    max_in_flight: int,
+    max_in_flight_bytes: int,
+    chunk_size: int,
+    batch_size: int,
+    new_hash: Callable[[], Hasher],
+) -> None:
+    """
+    Hash every unhashed file whose size is shared with another indexed file.
+
+    Stale files are left out, but current files from earlier runs are included,
+    so an interrupted scan or a newly added root still compares against them.
+    A file with a size of its own cannot have a duplicate, so it is never read.
+    Candidates are taken `batch_size` at a time in size order and hashed in
+    `(device, inode)` order within a batch. Files that disappeared since they
+    were listed keep an empty hash_id.
+    """
+    after: tuple[int, int] = (-1, 0)
+
+    while rows := store.get_unhashed_size_collisions(after=after, limit=batch_size):
+        after = (cast(int, rows[-1]["size"]), cast(int, rows[-1]["id"]))
+        rows.sort(key=lambda row: (cast(int, row["device"]), cast(int, row["inode"])))
+        print(f"Hashing {len(rows)} files with a shared size")
+
+        candidates: dict[str, sqlite3.Row] = {cast(str, row["path"]): row for row in rows}
+        digests: list[tuple[str, str]] = list(
+            hash_files_parallel_bounded(
+                files=((path, cast(int, row["size"])) for path, row in candidates.items()),
+                executor=executor,
+                max_in_flight=max_in_flight,
+                max_in_flight_bytes=max_in_flight_bytes,
+                chunk_size=chunk_size,
+                new_hash=new_hash,
+            )
+        )
+
+        store.begin()
+        try:
+            hash_ids: dict[str, int] = store.get_or_create_hashes(
+                [(hash_hex, cast(int, candidates[path]["size"])) for path, hash_hex in digests]
+            )
+            store.set_file_hash_ids_many(
+                [(hash_ids[hash_hex], cast(int, candidates[path]["id"])) for path, hash_hex in digests]
+            )
+            store.commit()
+        except Exception:
+            store.rollback()
+            raise
+
+
 def index_all_dirs(store: IndexStore, cfg: AppConfig) -> None:
+    """
+    Index pending directories until none remain.
+
+    Directories are claimed from the database in batches of CLAIM_BATCH_SIZE.
+    While one directory is being recorded, the next one in the batch is already
+    listed and stat'ed on a separate thread. Once every directory is done, only
+    files whose size occurs more than once are hashed.
+    """
+    if cfg.max_workers <= 0:
+        raise ValueError("max_workers must be > 0")
+
+    new_hash: Callable[[], Hasher] = resolve_hasher(cfg.hash_algo, max_workers=cfg.max_workers)
     scan_started_at: int = time.time_ns()
+    max_in_flight_bytes: int = int(cfg.io_bandwidth_mb_s * BYTES_PER_MB * TARGET_IO_BACKLOG_S)
 
     store.begin()
+    store.check_hash_algo(cfg.hash_algo.value)
     store.reset_inflight_dirs()
     store.commit()
 
-    store.begin()
-    while True:
-        dir_row: sqlite3.Row | None = store.get_next_pending_dir()
-
-        if dir_row is None:
-            break
+    store.begin_bulk_scan()
 
-        dir_id: int = cast(int, dir_row["id"])
-        dir_path: str = cast(str, dir_row["path"])
-        print(f"Indexing dir: {dir_path}")
-
-        store.mark_dir_indexing(dir_id=dir_id)
+    # Threads are enough: file reads and hashlib updates of 2 KiB or more release the GIL.
+    with (
+        ThreadPoolExecutor(max_workers=cfg.max_workers) as hash_executor,
+        ThreadPoolExecutor(max_workers=1) as discover_executor,
+    ):
+        while True:
+            store.begin()
+            dir_rows: list[sqlite3.Row] = store.claim_pending_dirs(limit=CLAIM_BATCH_SIZE)
+            store.commit()
 
-        index_single_dir(
+            if not dir_rows:
+                break
+
+            dir_paths: list[str] = [cast(str, row["path"]) for row in dir_rows]
+            next_entries: Future[tuple[list[str], list[tuple[str, os.stat_result]]]] = (
+                discover_executor.submit(discover_dir_entries, dir_paths[0])
+            )
+
+            for position, dir_row in enumerate(dir_rows):
+                dir_id: int = cast(int, dir_row["id"])
+                print(f"Indexing dir: {dir_paths[position]}")
+
+                subdirs, files = next_entries.result()
+                if position + 1 < len(dir_paths):
+                    next_entries = discover_executor.submit(discover_dir_entries, dir_paths[position + 1])
+
+                store.begin()
+                try:
+                    index_single_dir(
+                        store=store,
+                        dir_id=dir_id,
+                        subdirs=subdirs,
+                        files=files,
+                        seen_at=scan_started_at,
+                    )
+
+                    store.mark_dir_done(dir_id, seen_at=scan_started_at)
+                    store.commit()
+                except Exception:
+                    store.rollback()
+                    raise
+
+        hash_size_collisions(
             store=store,
-            dir_id=dir_id,
-            dir_path=Path(dir_path),
-            seen_at=scan_started_at,
-            max_workers=cfg.max_workers,
+            executor=hash_executor,
             max_in_flight=cfg.max_inflight,
+            max_in_flight_bytes=max_in_flight_bytes,
             chunk_size=cfg.chunk_size,
-            batch_size=500,
+            batch_size=cfg.batch_size,
+            new_hash=new_hash,
         )
 
-        store.mark_dir_done(dir_id, seen_at=scan_started_at)
-
-    store.commit()
+    store.end_bulk_scan()
 
 
 def index_command(cfg: AppConfig) -> None:
     typer.echo(f"🖥️  Gebruik {cfg.max_workers} CPU cores")
 
-    with IndexDB(cfg.db_path) as db:
+    with index_lock(cfg.db_path), IndexDB(cfg.db_path, synchronous=cfg.synchronous) as db:
         index_store: IndexStore = IndexStore(db)
         index_all_dirs(store=index_store, cfg=cfg)
@@ -1,19 +1,38 @@
 import sqlite3
-from collections.abc import Sequence
+from collections.abc import Iterable, Sequence
 from pathlib import Path
 from types import TracebackType
 from typing import cast
 
-from .sql import dirs, files, hashes
+from .sql import dirs, files, hashes, settings
+
+# OFF is opt-in: an OS crash or power loss while it is in effect can corrupt the
+# database, and a corrupt index has to be deleted by hand and rebuilt.
+SYNCHRONOUS_MODES: tuple[str, ...] = ("OFF", "NORMAL", "FULL")
+STATEMENT_CACHE_SIZE: int = 256
+# Page cache sizes in KiB (negative values for PRAGMA cache_size).
+CACHE_SIZE_KIB: int = 64 * 1024
+BULK_CACHE_SIZE_KIB: int = 256 * 1024
 
 
 class IndexDB:
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path, *, synchronous: str = "NORMAL") -> None:
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unsupported synchronous mode: {synchronous!r}")
+
+        self.synchronous: str = synchronous
         self.connection: sqlite3.Connection = sqlite3.connect(
-            path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None, check_same_thread=False
+            path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
         )
         self.connection.row_factory = sqlite3.Row
 
+        # Reused for statements that return no rows, so hot writes do not allocate a
+        # cursor per call. Compiled statements are cached by the connection itself.
+        self._write_cursor: sqlite3.Cursor = self.connection.cursor()
+
         self._configure()
         self._create_schema_if_needed()
 
@@ -28,36 +47,66 @@ class IndexDB:
     def _configure(self) -> None:
         cursor: sqlite3.Cursor = self.connection.cursor()
 
+        _ = cursor.execute("PRAGMA journal_mode = WAL;")
+        row: sqlite3.Row | None = cast(sqlite3.Row | None, cursor.fetchone())
+        journal_mode: str | None = cast(str, row[0]) if row is not None else None
+
+        if journal_mode is None or journal_mode.lower() != "wal":
+            self.connection.close()
+            raise RuntimeError(f"Unable to enable WAL journal mode (got {journal_mode!r}).")
+
         statements: list[str] = [
-            "PRAGMA journal_mode = WAL;",
-            "PRAGMA synchronous = NORMAL;",
+            f"PRAGMA synchronous = {self.synchronous};",
+            "PRAGMA temp_store = MEMORY;",
+            f"PRAGMA cache_size = -{CACHE_SIZE_KIB};",
+            "PRAGMA mmap_size = 268435456;",
+            "PRAGMA busy_timeout = 5000;",
             "PRAGMA foreign_keys = ON;",
         ]
 
         for statement in statements:
             _ = cursor.execute(statement)
 
+        cursor.close()
+
     def _create_schema_if_needed(self) -> None:
         self.begin()
 
-        self._apply_schema(table_sql=dirs.CREATE_TABLE, index_sql=dirs.CREATE_INDEXES)
+        self._apply_schema(table_sql=dirs.CREATE_TABLE, extra_sql=dirs.CREATE_INDEXES)
         self._apply_schema(table_sql=hashes.CREATE_TABLE)
-        self._apply_schema(table_sql=files.CREATE_TABLE)
+        self._migrate_nullable_hash_id()
+        self._apply_schema(table_sql=files.CREATE_TABLE, extra_sql=files.CREATE_INDEXES)
+        self._apply_schema(table_sql=files.CREATE_COUNTERS_TABLE, extra_sql=files.CREATE_COUNTERS)
+        self._apply_schema(table_sql=settings.CREATE_TABLE, extra_sql=settings.CREATE_DEFAULTS)
 
         self.commit()
 
-    def _apply_schema(self, *, table_sql: str, index_sql: Sequence[str] | None = None) -> None:
+    def _migrate_nullable_hash_id(self) -> None:
+        """
+        Rebuild a files table created while hash_id was still NOT NULL.
+        """
+        row: sqlite3.Row | None = self.query_one(files.SELECT_HASH_ID_NOT_NULL)
+        if row is None or not cast(int, row[0]):
+            return
+
+        for sql in files.MIGRATE_NULLABLE_HASH_ID:
+            self.execute(sql)
+
+    def _apply_schema(self, *, table_sql: str, extra_sql: Sequence[str] | None = None) -> None:
+        """
+        Create a table, then run its dependent statements (indexes, triggers, seed data).
+        """
         self.execute(sql=table_sql)
 
-        if index_sql is not None:
-            for sql in index_sql:
+        if extra_sql is not None:
+            for sql in extra_sql:
                 self.execute(sql)
 
     def cursor(self) -> sqlite3.Cursor:
         return self.connection.cursor()
 
     def begin(self) -> None:
-        _ = self.connection.execute("BEGIN;")
+        _ = self.connection.execute("BEGIN IMMEDIATE;")
 
     def commit(self) -> None:
         _ = self.connection.execute("COMMIT;")
@@ -65,20 +114,33 @@ class IndexDB:
     def rollback(self) -> None:
         _ = self.connection.execute("ROLLBACK;")
 
-    def execute(self, sql: str, params: Sequence[object] | None = None) -> None:
-        cursor: sqlite3.Cursor = self.connection.cursor()
+    def begin_bulk_scan(self) -> None:
+        """
+        Use a larger page cache while a scan runs.
+
+        Durability is left at the configured synchronous mode.
+        """
+        self.execute(f"PRAGMA cache_size = -{BULK_CACHE_SIZE_KIB};")
 
+    def end_bulk_scan(self) -> None:
+        """
+        Restore the regular settings and fold the WAL back into the database.
+        """
+        self.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB};")
+        self.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+    def execute(self, sql: str, params: Sequence[object] | None = None) -> None:
         if params is not None:
-            _ = cursor.execute(sql, params)
+            _ = self._write_cursor.execute(sql, params)
         else:
-            _ = cursor.execute(sql)
+            _ = self._write_cursor.execute(sql)
+
+    def executemany(self, sql: str, params: Iterable[Sequence[object]]) -> None:
+        _ = self._write_cursor.executemany(sql, params)
 
     def close(self) -> None:
         self.connection.close()
 
-    def fetchone(self, sql: str, params: Sequence[object]) -> object:
-        self.execute(sql=sql, params=params)
-
     def query_one(self, sql: str, params: Sequence[object] | None = None) -> sqlite3.Row | None:
         cursor: sqlite3.Cursor = self.connection.cursor()
 
@@ -91,3 +153,16 @@ class IndexDB:
         cursor.close()
 
         return row
+
+    def query_all(self, sql: str, params: Sequence[object] | None = None) -> list[sqlite3.Row]:
+        cursor: sqlite3.Cursor = self.connection.cursor()
+
+        if params is None:
+            _ = cursor.execute(sql)
+        else:
+            _ = cursor.execute(sql, params)
+        rows: list[sqlite3.Row] = cast(list[sqlite3.Row], cursor.fetchall())
+
+        cursor.close()
+
+        return rows
@@ -5,8 +5,8 @@ from typing import Annotated
 
 import typer
 
-from .config import CONFIG_FILENAME, AppConfig
-from .index import index_command
+from .config import CONFIG_FILENAME, AppConfig, ConfigError, HashAlgo, parse_chunk_size
+from .index import IndexLockedError, index_command
 from .index_db import IndexDB
 from .IndexStore import IndexStore
 from .status import status_command
@@ -44,34 +44,6 @@ def print_version(is_version: bool) -> None:
     raise typer.Exit()
 
 
-def parse_chunk_size(value: str) -> int:
-    # Normalize
-    text: str = value.strip().upper()
-
-    last_char: str = text[-1]
-    # Match "[number][optional suffix]"
-    if last_char in {"K", "M", "G"}:
-        number: str = text[:-1]
-        suffix: str | None = last_char
-    else:
-        number = text
-        suffix = None
-
-    try:
-        base: int = int(number)
-
-        if suffix == "K":
-            return base * 1024
-        elif suffix == "M":
-            return base * 1024 * 1024
-        elif suffix == "G":
-            return base * 1024 * 1024 * 1024
-        else:
-            return base
-    except ValueError:
-        raise ValueError("Specified chuck size is not a number. Only K, M and G are allowed suffixes.")
-
-
 def initialize_db_root_dirs(db_path: Path, root_paths: list[Path]) -> None:
     with IndexDB(db_path) as db:
         index_store: IndexStore = IndexStore(db)
@@ -89,8 +61,16 @@ def init(
     source_paths: list[Path],
     max_workers: Annotated[int, typer.Option()] = 0,
     max_inflight: Annotated[int, typer.Option()] = 200,
-    chunk_size: Annotated[int, typer.Option()] = 4096,
-    batch_size: Annotated[int, typer.Option()] = 500,
+    chunk_size: Annotated[
+        str, typer.Option(help="Size in bytes, or with suffix K/M/G (e.g. 32K, 4M, 1G)")
+    ] = "1M",
+    batch_size: Annotated[int, typer.Option()] = 10_000,
+    io_bandwidth_mb_s: Annotated[
+        int, typer.Option(min=1, help="Sustained read bandwidth of the source disks, in MB/s")
+    ] = 500,
+    hash_algo: Annotated[
+        HashAlgo, typer.Option(help="Content fingerprint; blake3 and xxh128 need the fast-hash extra")
+    ] = HashAlgo.SHA256,
     force: Annotated[bool, typer.Option()] = False,
 ) -> None:
     """
@@ -105,13 +85,20 @@ def init(
         typer.echo("Config file already exists. Use --force to overwrite.")
         raise typer.Exit(code=1)
 
+    try:
+        normalized_chunk_size: int = parse_chunk_size(chunk_size)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+
     cfg: AppConfig = AppConfig(
         root_paths=[p.resolve() for p in source_paths],
         db_path=Path("idem.db"),
         max_workers=max_workers if max_workers != 0 else multiprocessing.cpu_count(),
         max_inflight=max_inflight,
-        chunk_size=chunk_size,
+        chunk_size=normalized_chunk_size,
         batch_size=batch_size,
+        io_bandwidth_mb_s=io_bandwidth_mb_s,
+        hash_algo=hash_algo,
     )
 
     cfg.save(CONFIG_FILENAME)
@@ -150,6 +137,9 @@ def index(
         index_command(cfg)
     except FileNotFoundError as e:
         typer.echo(e)
+    except (ConfigError, IndexLockedError) as e:
+        typer.echo(e)
+        raise typer.Exit(code=1)
 
 
 @app.command()
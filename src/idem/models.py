@@ -9,7 +9,8 @@ class FileMetadata:
     mtime_ns: int
     inode: int
     device: int
-    hash_id: int
+    hash_id: int | None
+    last_seen: int | None
 
 
 @dataclass(slots=True)
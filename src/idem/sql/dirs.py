@@ -6,7 +6,12 @@ CREATE TABLE IF NOT EXISTS dirs (
     last_seen INTEGER
 );
 """
-CREATE_INDEXES: tuple[str, ...] = ("CREATE INDEX IF NOT EXISTS idx_dirs_status ON dirs(status);",)
+CREATE_INDEXES: tuple[str, ...] = (
+    # Ordered by (status, id): lets the pending-dir lookup walk the index without a sort.
+    "CREATE INDEX IF NOT EXISTS idx_dirs_status ON dirs(status);",
+    # Covering index for the status snapshot aggregates.
+    "CREATE INDEX IF NOT EXISTS idx_dirs_status_last_seen ON dirs(status, last_seen);",
+)
 
 INSERT_ROOT_DIR: str = """
     INSERT INTO dirs (
@@ -36,18 +41,17 @@ RESET_INFLIGHT_DIR: str = """
     WHERE status = 'indexing';
 """
 
-GET_NEXT_PENDING_DIR = """
-    SELECT id, path
-    FROM dirs
-    WHERE status = 'pending'
-    ORDER BY id
-    LIMIT 1;
-"""
-
-MARK_AS_INDEXING: str = """
+CLAIM_PENDING_DIRS: str = """
     UPDATE dirs
     SET status = 'indexing'
-    WHERE id = ?;
+    WHERE id IN (
+        SELECT id
+        FROM dirs
+        WHERE status = 'pending'
+        ORDER BY id
+        LIMIT ?
+    )
+    RETURNING id, path;
 """
 
 MARK_AS_DONE: str = """
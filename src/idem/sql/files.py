@@ -7,11 +7,123 @@ CREATE_TABLE: str = """
         mtime_ns  INTEGER NOT NULL,
         inode     INTEGER NOT NULL,
         device    INTEGER NOT NULL,
-        hash_id   INTEGER NOT NULL,
+        hash_id   INTEGER,
         last_seen INTEGER
     );
 """
 
+# hash_id used to be NOT NULL; rebuild such a table so files can be recorded before
+# they are hashed. Indexes and triggers are dropped with the old table and created
+# again by CREATE_INDEXES and CREATE_COUNTERS.
+SELECT_HASH_ID_NOT_NULL: str = """
+    SELECT "notnull"
+    FROM pragma_table_info('files')
+    WHERE name = 'hash_id';
+"""
+
+MIGRATE_NULLABLE_HASH_ID: tuple[str, ...] = (
+    """
+    CREATE TABLE files_new (
+        id        INTEGER PRIMARY KEY,
+        path      TEXT NOT NULL UNIQUE,
+        dir_id    INTEGER NOT NULL,
+        size      INTEGER NOT NULL,
+        mtime_ns  INTEGER NOT NULL,
+        inode     INTEGER NOT NULL,
+        device    INTEGER NOT NULL,
+        hash_id   INTEGER,
+        last_seen INTEGER
+    );
+    """,
+    """
+    INSERT INTO files_new (id, path, dir_id, size, mtime_ns, inode, device, hash_id, last_seen)
+    SELECT id, path, dir_id, size, mtime_ns, inode, device, hash_id, last_seen
+    FROM files;
+    """,
+    # Files were never marked as seen back then; an empty last_seen now means
+    # stale, so take it from the directory that was indexed instead.
+    """
+    UPDATE files_new
+    SET last_seen = (SELECT last_seen FROM dirs WHERE dirs.id = files_new.dir_id AND dirs.status = 'done')
+    WHERE last_seen IS NULL;
+    """,
+    "DROP TABLE files;",
+    "ALTER TABLE files_new RENAME TO files;",
+)
+
+CREATE_INDEXES: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS idx_files_last_seen ON files(last_seen);",
+    # Covering index for the content statistics and the unhashed-file scan.
+    # It replaces idx_files_hash_id_size, which is a prefix of it.
+    "DROP INDEX IF EXISTS idx_files_hash_id_size;",
+    "CREATE INDEX IF NOT EXISTS idx_files_hash_id_size_last_seen ON files(hash_id, size, id, last_seen);",
+    # Covering index for the per-directory stat comparison.
+    # It replaces idx_files_dir_id, which is a prefix of it.
+    "DROP INDEX IF EXISTS idx_files_dir_id;",
+    """
+    CREATE INDEX IF NOT EXISTS idx_files_dir_stat
+        ON files(dir_id, path, size, mtime_ns, inode, device, hash_id);
+    """,
+    # Finds the other current files of a size when looking for files that need a hash.
+    # It replaces idx_files_size, which is a prefix of it.
+    "DROP INDEX IF EXISTS idx_files_size;",
+    "CREATE INDEX IF NOT EXISTS idx_files_size_last_seen ON files(size, last_seen);",
+)
+
+# Running totals over the files table, kept up to date by triggers so the
+# status snapshot does not have to scan every file.
+CREATE_COUNTERS_TABLE: str = """
+    CREATE TABLE IF NOT EXISTS file_counters (
+        bucket TEXT PRIMARY KEY,
+        value  INTEGER NOT NULL
+    );
+"""
+
+CREATE_COUNTERS: tuple[str, ...] = (
+    # Seed from existing rows once, when the counters are first created.
+    """
+    INSERT OR IGNORE INTO file_counters (bucket, value)
+    SELECT 'total_files', COUNT(*) FROM files
+    WHERE NOT EXISTS (SELECT 1 FROM file_counters)
+    UNION ALL
+    SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM files
+    WHERE NOT EXISTS (SELECT 1 FROM file_counters);
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_files_counters_insert
+    AFTER INSERT ON files
+    BEGIN
+        UPDATE file_counters SET value = value + 1 WHERE bucket = 'total_files';
+        UPDATE file_counters SET value = value + new.size WHERE bucket = 'total_bytes';
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_files_counters_delete
+    AFTER DELETE ON files
+    BEGIN
+        UPDATE file_counters SET value = value - 1 WHERE bucket = 'total_files';
+        UPDATE file_counters SET value = value - old.size WHERE bucket = 'total_bytes';
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_files_counters_update_size
+    AFTER UPDATE OF size ON files
+    WHEN new.size != old.size
+    BEGIN
+        UPDATE file_counters SET value = value + new.size - old.size WHERE bucket = 'total_bytes';
+    END;
+    """,
+)
+
+SELECT_FILE_STATS: str = """
+    SELECT
+    (SELECT value FROM file_counters WHERE bucket = 'total_files') AS total_files,
+    (SELECT value FROM file_counters WHERE bucket = 'total_bytes') AS total_bytes,
+    (SELECT COUNT(*) FROM files WHERE last_seen IS NULL) AS stale_files,
+    (SELECT COUNT(*) FROM files WHERE last_seen < ?) AS older_files,
+    (SELECT COUNT(*) FROM files WHERE last_seen > ?) AS newer_files;
+"""
+
 UPSERT_FILE_METEDATA: str = """
     INSERT INTO files (
         path,
@@ -20,27 +132,61 @@ UPSERT_FILE_METEDATA: str = """
         mtime_ns,
         inode,
         device,
-        hash_id
+        hash_id,
+        last_seen
     )
-    VALUES (?, ?, ?, ?, ?, ?, ?)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ON CONFLICT(path) DO UPDATE SET
         dir_id    = excluded.dir_id,
         size      = excluded.size,
         mtime_ns  = excluded.mtime_ns,
         inode     = excluded.inode,
         device    = excluded.device,
-        hash_id   = excluded.hash_id
+        hash_id   = excluded.hash_id,
+        last_seen = excluded.last_seen
     WHERE
         files.dir_id    != excluded.dir_id
         OR files.size      != excluded.size
         OR files.mtime_ns  != excluded.mtime_ns
         OR files.inode     != excluded.inode
         OR files.device    != excluded.device
-        OR files.hash_id   != excluded.hash_id;
+        OR files.hash_id   IS NOT excluded.hash_id
+        OR files.last_seen IS NOT excluded.last_seen;
 """
 
-UPDATE_LAST_SEEN: str = """
-    UPDATE files
-    SET last_seen = ?
+SELECT_METADATA_BY_DIR: str = """
+    SELECT path, size, mtime_ns, inode, device, hash_id
+    FROM files
     WHERE dir_id = ?;
 """
+
+# A file that is no longer in its directory is kept, with an empty last_seen.
+MARK_STALE: str = """
+    UPDATE files
+    SET last_seen = NULL
+    WHERE path = ?;
+"""
+
+# Unhashed current files that share their size with at least one other current file,
+# in (size, id) order after the given (size, id), so idx_files_hash_id_size_last_seen
+# serves the scan and the sort. Stale files are left out on both sides.
+SELECT_UNHASHED_SIZE_COLLISIONS: str = """
+    SELECT id, path, size, inode, device
+    FROM files AS f
+    WHERE f.hash_id IS NULL
+        AND f.last_seen IS NOT NULL
+        AND (f.size, f.id) > (?, ?)
+        AND EXISTS (
+            SELECT 1
+            FROM files AS other
+            WHERE other.size = f.size AND other.last_seen IS NOT NULL AND other.id != f.id
+        )
+    ORDER BY f.size, f.id
+    LIMIT ?;
+"""
+
+UPDATE_HASH_ID: str = """
+    UPDATE files
+    SET hash_id = ?
+    WHERE id = ?;
+"""
@@ -6,11 +6,16 @@ CREATE_TABLE: str = """
     );
 """
 
-GET_HASH_ID: str = """SELECT id from hashes WHERE hash = ?;"""
-
 STORE_HASH: str = """
     INSERT INTO hashes(hash, size)
         VALUES (?, ?)
         ON CONFLICT(hash) DO NOTHING
     ;
 """
+
+# Formatted with one "?" per hash; callers keep the list under SQLite's variable limit.
+SELECT_IDS_BY_HASH: str = """
+    SELECT id, hash
+    FROM hashes
+    WHERE hash IN ({placeholders});
+"""
@@ -0,0 +1,28 @@
+CREATE_TABLE: str = """
+    CREATE TABLE IF NOT EXISTS settings (
+        key    TEXT PRIMARY KEY,
+        value  TEXT NOT NULL
+    ) WITHOUT ROWID;
+"""
+
+CREATE_DEFAULTS: tuple[str, ...] = (
+    # Indexes created before hash_algo existed only hold SHA-256 digests.
+    """
+    INSERT OR IGNORE INTO settings(key, value)
+        SELECT 'hash_algo', 'sha256'
+        WHERE EXISTS (SELECT 1 FROM hashes);
+    """,
+)
+
+INSERT_SETTING: str = """
+    INSERT INTO settings(key, value)
+        VALUES (?, ?)
+        ON CONFLICT(key) DO NOTHING
+    ;
+"""
+
+SELECT_SETTING: str = """
+    SELECT value
+    FROM settings
+    WHERE key = ?;
+"""
@@ -0,0 +1,18 @@
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+from idem.index_db import IndexDB
+from idem.IndexStore import IndexStore
+
+
+@pytest.fixture
+def db(tmp_path: Path) -> Iterator[IndexDB]:
+    with IndexDB(tmp_path / "idem.db") as index_db:
+        yield index_db
+
+
+@pytest.fixture
+def store(db: IndexDB) -> IndexStore:
+    return IndexStore(db)
@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import pytest
+
+from idem.config import AppConfig, ConfigError, parse_chunk_size
+
+
+def write_config(path: Path, **overrides: str) -> Path:
+    """
+    Save a default config, with the given keys replaced by raw YAML values.
+    """
+    cfg: AppConfig = AppConfig(
+        root_paths=[Path("/data")],
+        db_path=Path("idem.db"),
+        max_workers=1,
+        max_inflight=1,
+        chunk_size=1024,
+        batch_size=10,
+    )
+    cfg.save(path)
+
+    lines: list[str] = [
+        line
+        for line in path.read_text(encoding="utf-8").splitlines()
+        if line.strip().split(":")[0] not in overrides
+    ]
+    lines.extend(f"  {key}: {value}" for key, value in overrides.items())
+    _ = path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    return path
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("4096", 4096),
+        ("4K", 4 * 1024),
+        ("4k", 4 * 1024),
+        ("1M", 1024 * 1024),
+        (" 2m ", 2 * 1024 * 1024),
+        ("1G", 1024 * 1024 * 1024),
+    ],
+)
+def test_parse_chunk_size(value: str, expected: int) -> None:
+    assert parse_chunk_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "M", "1T", "1.5M", "1MB", "abc"])
+def test_parse_chunk_size_rejects_invalid_sizes(value: str) -> None:
+    with pytest.raises(ValueError, match="Only K, M and G are allowed suffixes"):
+        _ = parse_chunk_size(value)
+
+
+@pytest.mark.parametrize(("value", "expected"), [("full", "FULL"), ("OFF", "OFF"), ("Normal", "NORMAL")])
+def test_load_accepts_synchronous_modes_in_any_case(tmp_path: Path, value: str, expected: str) -> None:
+    path: Path = write_config(tmp_path / "config.yaml", synchronous=value)
+
+    assert AppConfig.load(path).synchronous == expected
+
+
+def test_load_rejects_an_unknown_synchronous_mode(tmp_path: Path) -> None:
+    path: Path = write_config(tmp_path / "config.yaml", synchronous="fast")
+
+    with pytest.raises(ConfigError, match="synchronous must be one of OFF, NORMAL, FULL, got 'fast'"):
+        _ = AppConfig.load(path)
+
+
+@pytest.mark.parametrize("value", ["0", "-5", "fast", "1.5"])
+def test_load_rejects_an_invalid_io_bandwidth(tmp_path: Path, value: str) -> None:
+    path: Path = write_config(tmp_path / "config.yaml", io_bandwidth_mb_s=value)
+
+    with pytest.raises(ConfigError, match="io_bandwidth_mb_s must be a whole number of MB/s above 0"):
+        _ = AppConfig.load(path)
@@ -0,0 +1,365 @@
+import functools
+import os
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Executor, Future
+from pathlib import Path
+from typing import cast, override
+
+import pytest
+
+import idem.index
+from idem.config import AppConfig
+from idem.index import (
+    FILES_PER_TASK,
+    SMALL_FILE_SIZE,
+    IndexLockedError,
+    discover_dir_entries,
+    hash_files_parallel_bounded,
+    index_all_dirs,
+    index_lock,
+)
+from idem.index_db import IndexDB
+from idem.IndexStore import IndexStore
+from idem.models import StatusSnapshot
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> Path:
+    root_dir: Path = tmp_path / "data"
+    (root_dir / "sub").mkdir(parents=True)
+
+    _ = (root_dir / "a.bin").write_bytes(b"a" * 100)
+    _ = (root_dir / "sub" / "b.bin").write_bytes(b"a" * 100)
+    _ = (root_dir / "sub" / "c.bin").write_bytes(b"c" * 100)
+    _ = (root_dir / "unique.bin").write_bytes(b"u" * 200)
+
+    return root_dir
+
+
+def make_config(*roots: Path) -> AppConfig:
+    return AppConfig(
+        root_paths=list(roots),
+        db_path=Path("unused.db"),
+        max_workers=2,
+        max_inflight=2,
+        chunk_size=64,
+        batch_size=2,
+    )
+
+
+def index(store: IndexStore, *roots: Path) -> None:
+    """
+    Index the way `idem init`/`idem add` followed by `idem index` does.
+    """
+    store.begin()
+    store.insert_root_dirs([str(root) for root in roots])
+    store.commit()
+
+    index_all_dirs(store=store, cfg=make_config(*roots))
+
+
+def scan(store: IndexStore, root: Path) -> None:
+    """
+    Index `root` from scratch or, when it was indexed before, rescan it.
+
+    idem has no rescan command yet, so every directory is put back to pending.
+    """
+    store.begin()
+    store.insert_root_dirs([str(root)])
+    store.db.execute("UPDATE dirs SET status = 'pending';")
+    store.commit()
+
+    index_all_dirs(store=store, cfg=make_config(root))
+
+
+def hash_ids(db: IndexDB, root: Path) -> dict[str, int | None]:
+    rows = db.query_all("SELECT path, hash_id FROM files;")
+
+    return {os.path.relpath(cast(str, row["path"]), root): cast(int | None, row["hash_id"]) for row in rows}
+
+
+def test_only_files_with_a_shared_size_are_hashed(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+
+    ids: dict[str, int | None] = hash_ids(store.db, root)
+
+    assert ids["unique.bin"] is None
+    assert ids["a.bin"] is not None
+    assert ids["a.bin"] == ids["sub/b.bin"]
+    assert ids["sub/c.bin"] is not None
+    assert ids["sub/c.bin"] != ids["a.bin"]
+
+
+def test_changed_file_is_hashed_again_on_rescan(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+    before: dict[str, int | None] = hash_ids(store.db, root)
+
+    changed: Path = root / "sub" / "b.bin"
+    _ = changed.write_bytes(b"c" * 100)
+    st: os.stat_result = changed.stat()
+    os.utime(changed, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    scan(store, root)
+    after: dict[str, int | None] = hash_ids(store.db, root)
+
+    assert after["a.bin"] == before["a.bin"]
+    assert after["sub/b.bin"] == before["sub/c.bin"]
+    assert after["unique.bin"] is None
+
+
+def test_unhashed_file_is_hashed_once_its_size_is_shared(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+    _ = (root / "sub" / "twin.bin").write_bytes(b"u" * 200)
+
+    scan(store, root)
+    ids: dict[str, int | None] = hash_ids(store.db, root)
+
+    assert ids["unique.bin"] is not None
+    assert ids["unique.bin"] == ids["sub/twin.bin"]
+
+
+def test_rescan_marks_files_seen_and_removed_files_stale(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+    first: StatusSnapshot = store.get_status_snapshot()
+
+    assert first.total_files == 4
+    assert first.files_seen_last_scan == 4
+    assert first.stale_files == 0
+
+    (root / "sub" / "c.bin").unlink()
+    scan(store, root)
+    second: StatusSnapshot = store.get_status_snapshot()
+
+    assert second.total_files == 4
+    assert second.files_seen_last_scan == 3
+    assert second.stale_files == 1
+
+
+def test_content_stats_leave_out_stale_files(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+    first: StatusSnapshot = store.get_status_snapshot()
+
+    assert first.unique_hashes == 2
+    assert first.duplicate_groups == 1
+    assert first.duplicate_files == 2
+
+    # The remaining copy is unique now; the stale row must not keep it a duplicate.
+    (root / "sub" / "b.bin").unlink()
+    scan(store, root)
+    second: StatusSnapshot = store.get_status_snapshot()
+
+    assert second.unique_hashes == 3
+    assert second.duplicate_groups == 0
+    assert second.duplicate_files == 0
+
+
+def test_stale_file_does_not_trigger_hashing(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+
+    _ = (root / "unique.bin").rename(root / "moved.bin")
+    scan(store, root)
+    ids: dict[str, int | None] = hash_ids(store.db, root)
+
+    assert ids["moved.bin"] is None
+    assert store.get_status_snapshot().unique_hashes == 2
+
+
+def test_unhashed_file_with_a_shared_size_is_not_unique(store: IndexStore, root: Path) -> None:
+    scan(store, root)
+
+    # A failed read leaves hash_id empty even though the size is shared.
+    store.db.execute("UPDATE files SET hash_id = NULL WHERE path LIKE '%c.bin';")
+
+    assert store.get_status_snapshot().unique_hashes == 1
+
+
+def test_interrupted_collision_pass_is_finished_on_the_next_run(
+    store: IndexStore, root: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def interrupt(**_: object) -> None:
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(idem.index, "hash_size_collisions", interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            index(store, root)
+
+    assert all(hash_id is None for hash_id in hash_ids(store.db, root).values())
+
+    # Every directory is done, so the next run only has the collision pass left.
+    index(store, root)
+    ids: dict[str, int | None] = hash_ids(store.db, root)
+
+    assert ids["a.bin"] is not None
+    assert ids["a.bin"] == ids["sub/b.bin"]
+    assert store.get_status_snapshot().duplicate_groups == 1
+
+
+def test_added_root_is_compared_with_files_already_indexed(
+    store: IndexStore, root: Path, tmp_path: Path
+) -> None:
+    index(store, root)
+
+    other: Path = tmp_path / "other"
+    other.mkdir()
+    _ = (other / "unique_copy.bin").write_bytes(b"u" * 200)
+
+    index(store, root, other)
+    ids: dict[str, int | None] = hash_ids(store.db, tmp_path)
+    snapshot: StatusSnapshot = store.get_status_snapshot()
+
+    assert ids["data/unique.bin"] is not None
+    assert ids["data/unique.bin"] == ids["other/unique_copy.bin"]
+    assert snapshot.duplicate_groups == 2
+    assert snapshot.stale_files == 0
+
+
+def test_index_lock_refuses_a_second_holder(tmp_path: Path) -> None:
+    db_path: Path = tmp_path / "idem.db"
+
+    with index_lock(db_path):
+        with pytest.raises(IndexLockedError), index_lock(db_path):
+            pass
+
+    # Released on exit, so the next run can take it.
+    with index_lock(db_path):
+        pass
+
+
+def test_unlistable_directory_has_no_entries(root: Path) -> None:
+    assert discover_dir_entries(str(root / "a.bin")) == ([], [])
+    assert discover_dir_entries(str(root / "missing")) == ([], [])
+
+
+def test_unreadable_directory_does_not_abort_the_run(
+    store: IndexStore, root: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    unreadable: str = str(root / "sub")
+    scandir = os.scandir
+
+    def guarded_scandir(path: str) -> Iterator[os.DirEntry[str]]:
+        if path == unreadable:
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", guarded_scandir)
+    index(store, root)
+    snapshot: StatusSnapshot = store.get_status_snapshot()
+
+    assert snapshot.done_dirs == 2
+    assert snapshot.indexing_dirs == 0
+    assert snapshot.total_files == 2
+
+
+class QueueingExecutor(Executor):
+    """
+    Queue tasks without running them, so the test decides when each one finishes.
+    """
+
+    def __init__(self, sizes: dict[str, int]) -> None:
+        self.sizes: dict[str, int] = sizes
+        self.queued: list[tuple[Future[object], Callable[[], object], list[str]]] = []
+        self.batches: list[list[str]] = []
+        self.max_queued_tasks: int = 0
+        self.max_queued_bytes: int = 0
+
+    @override
+    def submit[**P, T](self, fn: Callable[P, T], /, *args: P.args, **kwargs: P.kwargs) -> Future[T]:
+        batch: list[str] = cast(list[str], args[0])
+        future: Future[T] = Future()
+        self.queued.append((cast(Future[object], future), functools.partial(fn, *args, **kwargs), batch))
+        self.batches.append(batch)
+
+        queued_bytes: int = sum(self.sizes[path] for _, _, paths in self.queued for path in paths)
+        self.max_queued_tasks = max(self.max_queued_tasks, len(self.queued))
+        self.max_queued_bytes = max(self.max_queued_bytes, queued_bytes)
+
+        return future
+
+    def finish_oldest(self) -> Future[object]:
+        future, call, _ = self.queued.pop(0)
+        future.set_result(call())
+
+        return future
+
+
+@pytest.fixture
+def queueing_executor(monkeypatch: pytest.MonkeyPatch) -> Callable[[dict[str, int]], QueueingExecutor]:
+    def make(sizes: dict[str, int]) -> QueueingExecutor:
+        executor: QueueingExecutor = QueueingExecutor(sizes)
+
+        def calculate_digest_batch(paths: list[str], *_: object) -> list[tuple[str, str]]:
+            return [(path, f"digest-{path}") for path in paths]
+
+        def wait(
+            fs: Iterable[Future[object]], return_when: str
+        ) -> tuple[set[Future[object]], set[Future[object]]]:
+            assert return_when == FIRST_COMPLETED
+            finished: Future[object] = executor.finish_oldest()
+            return {finished}, set(fs) - {finished}
+
+        def as_completed(fs: Iterable[Future[object]]) -> Iterator[Future[object]]:
+            for _ in list(fs):
+                yield executor.finish_oldest()
+
+        monkeypatch.setattr(idem.index, "calculate_digest_batch", calculate_digest_batch)
+        monkeypatch.setattr(idem.index, "wait", wait)
+        monkeypatch.setattr(idem.index, "as_completed", as_completed)
+
+        return executor
+
+    return make
+
+
+def test_hashing_is_bounded_by_task_count_and_bytes(
+    queueing_executor: Callable[[dict[str, int]], QueueingExecutor],
+) -> None:
+    sizes: dict[str, int] = {f"small{i}": 1000 for i in range(40)}
+    sizes.update({f"large{i}": 100_000 for i in range(10)})
+    executor: QueueingExecutor = queueing_executor(sizes)
+
+    digests: list[tuple[str, str]] = list(
+        hash_files_parallel_bounded(
+            files=sizes.items(),
+            executor=executor,
+            max_in_flight=3,
+            chunk_size=64,
+            max_in_flight_bytes=250_000,
+        )
+    )
+
+    assert sorted(path for path, _ in digests) == sorted(sizes)
+    assert executor.max_queued_tasks == 3
+    assert executor.max_queued_bytes <= 250_000
+
+    small_batches: list[list[str]] = [batch for batch in executor.batches if batch[0].startswith("small")]
+    large_batches: list[list[str]] = [batch for batch in executor.batches if batch[0].startswith("large")]
+
+    assert [len(batch) for batch in small_batches] == [
+        FILES_PER_TASK,
+        FILES_PER_TASK,
+        40 - 2 * FILES_PER_TASK,
+    ]
+    assert all(len(batch) == 1 for batch in large_batches)
+    assert all(sizes[path] < SMALL_FILE_SIZE for batch in small_batches for path in batch)
+
+
+def test_file_larger_than_the_byte_budget_is_hashed_on_its_own(
+    queueing_executor: Callable[[dict[str, int]], QueueingExecutor],
+) -> None:
+    sizes: dict[str, int] = {"large0": 100_000, "huge": 1_000_000, "large1": 100_000}
+    executor: QueueingExecutor = queueing_executor(sizes)
+
+    digests: list[tuple[str, str]] = list(
+        hash_files_parallel_bounded(
+            files=sizes.items(),
+            executor=executor,
+            max_in_flight=3,
+            chunk_size=64,
+            max_in_flight_bytes=250_000,
+        )
+    )
+
+    assert sorted(path for path, _ in digests) == sorted(sizes)
+    assert executor.max_queued_bytes == 1_000_000
+    assert executor.max_queued_tasks == 1
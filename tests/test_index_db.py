@@ -0,0 +1,166 @@
+import sqlite3
+from pathlib import Path
+from typing import cast
+
+import pytest
+
+from idem.index_db import IndexDB
+from idem.IndexStore import IndexStore
+from idem.models import FileMetadata
+
+# Schema as written by the first release, where every file row needed a hash.
+BASELINE_SCHEMA: str = """
+CREATE TABLE dirs (
+    id        INTEGER PRIMARY KEY,
+    path      TEXT NOT NULL UNIQUE,
+    status    TEXT NOT NULL CHECK (status IN ('pending', 'indexing', 'done')),
+    last_seen INTEGER
+);
+CREATE INDEX idx_dirs_status ON dirs(status);
+CREATE TABLE hashes (
+    id    INTEGER PRIMARY KEY,
+    hash  TEXT NOT NULL UNIQUE,
+    size  INTEGER NOT NULL
+);
+CREATE TABLE files (
+    id        INTEGER PRIMARY KEY,
+    path      TEXT NOT NULL UNIQUE,
+    dir_id    INTEGER NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    inode     INTEGER NOT NULL,
+    device    INTEGER NOT NULL,
+    hash_id   INTEGER NOT NULL,
+    last_seen INTEGER
+);
+CREATE INDEX idx_files_dir_id ON files(dir_id);
+INSERT INTO dirs (id, path, status, last_seen) VALUES (1, '/data', 'done', 100);
+INSERT INTO hashes (id, hash, size) VALUES (1, 'aa', 10), (2, 'bb', 20);
+INSERT INTO files (id, path, dir_id, size, mtime_ns, inode, device, hash_id, last_seen) VALUES
+    (1, '/data/a', 1, 10, 1, 11, 1, 1, 100),
+    (2, '/data/b', 1, 10, 2, 12, 1, 1, 100),
+    (3, '/data/c', 1, 20, 3, 13, 1, 2, NULL);
+"""
+
+
+def make_baseline_db(path: Path) -> None:
+    connection: sqlite3.Connection = sqlite3.connect(path)
+    try:
+        _ = connection.executescript(BASELINE_SCHEMA)
+    finally:
+        connection.close()
+
+
+def assert_counters_match(db: IndexDB) -> None:
+    row = db.query_one(
+        """
+        SELECT
+        (SELECT value FROM file_counters WHERE bucket = 'total_files') AS total_files,
+        (SELECT value FROM file_counters WHERE bucket = 'total_bytes') AS total_bytes,
+        (SELECT COUNT(*) FROM files) AS count_files,
+        (SELECT COALESCE(SUM(size), 0) FROM files) AS sum_size;
+        """
+    )
+
+    assert row is not None
+    assert row["total_files"] == row["count_files"]
+    assert row["total_bytes"] == row["sum_size"]
+
+
+def file_meta(path: str, size: int) -> FileMetadata:
+    return FileMetadata(
+        path=path, dir_id=1, size=size, mtime_ns=1, inode=1, device=1, hash_id=None, last_seen=1
+    )
+
+
+def test_baseline_index_is_migrated_to_nullable_hash_id(tmp_path: Path) -> None:
+    db_path: Path = tmp_path / "idem.db"
+    make_baseline_db(db_path)
+
+    with IndexDB(db_path) as db:
+        notnull = db.query_one("SELECT \"notnull\" FROM pragma_table_info('files') WHERE name = 'hash_id';")
+        rows = db.query_all("SELECT id, path, size, hash_id, last_seen FROM files ORDER BY id;")
+        hash_algo = db.query_one("SELECT value FROM settings WHERE key = 'hash_algo';")
+
+        assert notnull is not None and notnull[0] == 0
+        # The first release never set last_seen; it is taken from the indexed directory.
+        assert [tuple(row) for row in rows] == [
+            (1, "/data/a", 10, 1, 100),
+            (2, "/data/b", 10, 1, 100),
+            (3, "/data/c", 20, 2, 100),
+        ]
+        assert hash_algo is not None and hash_algo["value"] == "sha256"
+
+        db.begin()
+        IndexStore(db).upsert_file_metadata_many([file_meta("/data/d", 30)])
+        db.commit()
+
+        row = db.query_one("SELECT hash_id FROM files WHERE path = '/data/d';")
+        assert row is not None and row["hash_id"] is None
+
+    # A second open finds nothing left to migrate.
+    with IndexDB(db_path) as db:
+        count = db.query_one("SELECT COUNT(*) FROM files;")
+        assert count is not None and count[0] == 4
+
+
+def test_counters_are_seeded_from_an_existing_index(tmp_path: Path) -> None:
+    db_path: Path = tmp_path / "idem.db"
+    make_baseline_db(db_path)
+
+    with IndexDB(db_path) as db:
+        assert_counters_match(db)
+        total = db.query_one("SELECT value FROM file_counters WHERE bucket = 'total_bytes';")
+        assert total is not None and total[0] == 40
+
+    # Seeding happens once; reopening must not count the files again.
+    with IndexDB(db_path) as db:
+        assert_counters_match(db)
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "DELETE FROM files WHERE path = '/x/a';",
+        "UPDATE files SET size = 500 WHERE path = '/x/b';",
+        "UPDATE files SET mtime_ns = 5 WHERE path = '/x/b';",
+        "DELETE FROM files;",
+    ],
+)
+def test_counters_follow_file_changes(db: IndexDB, statement: str) -> None:
+    store: IndexStore = IndexStore(db)
+
+    db.begin()
+    store.upsert_file_metadata_many([file_meta("/x/a", 10), file_meta("/x/b", 20), file_meta("/x/c", 30)])
+    db.commit()
+    assert_counters_match(db)
+
+    db.execute(statement)
+    assert_counters_match(db)
+
+
+def test_counters_follow_upserted_size_changes(db: IndexDB) -> None:
+    store: IndexStore = IndexStore(db)
+
+    db.begin()
+    store.upsert_file_metadata_many([file_meta("/x/a", 10), file_meta("/x/b", 20)])
+    store.upsert_file_metadata_many([file_meta("/x/a", 15), file_meta("/x/c", 5)])
+    db.commit()
+
+    assert_counters_match(db)
+    row = db.query_one("SELECT value FROM file_counters WHERE bucket = 'total_bytes';")
+    assert row is not None and cast(int, row[0]) == 40
+
+
+@pytest.mark.parametrize(("synchronous", "expected"), [("OFF", 0), ("NORMAL", 1), ("FULL", 2)])
+def test_bulk_scan_keeps_the_configured_synchronous_mode(
+    tmp_path: Path, synchronous: str, expected: int
+) -> None:
+    with IndexDB(tmp_path / "idem.db", synchronous=synchronous) as db:
+        db.begin_bulk_scan()
+        during = db.query_one("PRAGMA synchronous;")
+        db.end_bulk_scan()
+        after = db.query_one("PRAGMA synchronous;")
+
+        assert during is not None and during[0] == expected
+        assert after is not None and after[0] == expected
@@ -0,0 +1,19 @@
+import pytest
+
+from idem.config import ConfigError
+from idem.IndexStore import IndexStore
+
+
+def test_check_hash_algo_records_the_first_algorithm(store: IndexStore) -> None:
+    store.check_hash_algo("blake3")
+    store.check_hash_algo("blake3")
+
+    row = store.db.query_one("SELECT value FROM settings WHERE key = 'hash_algo';")
+    assert row is not None and row["value"] == "blake3"
+
+
+def test_check_hash_algo_rejects_a_different_algorithm(store: IndexStore) -> None:
+    store.check_hash_algo("sha256")
+
+    with pytest.raises(ConfigError, match="built with hash_algo 'sha256'.*asks for 'xxh128'"):
+        store.check_hash_algo("xxh128")
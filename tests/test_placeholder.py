@@ -1,3 +0,0 @@
-def test_placeholder() -> None:
-    """Placeholder test to keep CI green until real tests exist."""
-    assert True